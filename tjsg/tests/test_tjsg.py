@@ -1,17 +1,35 @@
+import collections
 import copy
+import pickle
 
-import deepdiff
 import jsonschema
 import pytest
 
-from tjsg import JSONSchemaPrimitiveType, compile_schema, jst
+from tjsg import JSONSchemaPrimitiveType, compile_schema, jst, make_validator
 
 # the schema validator to use
 check_schema = jsonschema.validators.Draft7Validator.check_schema
 
 
-def diff_schemas(schema1, schema2):
-    return deepdiff.DeepDiff(schema1, schema2, ignore_order=True)
+def _normalize(schema):
+    '''
+    Sort, in place, the lists of types in a (compiled) schema,
+    since the order of the types in a union type is not meaningful
+    '''
+    if isinstance(schema, dict):
+        types = schema.get('type')
+        if isinstance(types, list):
+            schema['type'] = sorted(types)
+        for value in schema.values():
+            _normalize(value)
+    elif isinstance(schema, list):
+        for value in schema:
+            _normalize(value)
+    return schema
+
+
+def assert_schema_equal(actual, expected):
+    assert _normalize(copy.deepcopy(actual)) == _normalize(copy.deepcopy(expected))
 
 
 def test_json_primitive_type_compile():
@@ -21,24 +39,24 @@ def test_json_primitive_type_compile():
 
     # a literal type
     schema = JSONSchemaPrimitiveType('number').compile()
-    assert not diff_schemas(schema, {'type': 'number'})
+    assert_schema_equal(schema, {'type': 'number'})
 
     # union type
     schema = JSONSchemaPrimitiveType(['number', 'null']).compile()
-    assert not diff_schemas(schema, {'type': ['null', 'number']})
+    assert_schema_equal(schema, {'type': ['null', 'number']})
 
     # array type
     schema = JSONSchemaPrimitiveType('array', items='string').compile()
-    assert not diff_schemas(schema, {'type': 'array', 'items': {'type': 'string'}})
+    assert_schema_equal(schema, {'type': 'array', 'items': {'type': 'string'}})
 
     # array of a union type
     schema = JSONSchemaPrimitiveType('array', items=['number', 'null']).compile()
-    assert not diff_schemas(schema, {'type': 'array', 'items': {'type': ['number', 'null']}})
+    assert_schema_equal(schema, {'type': 'array', 'items': {'type': ['number', 'null']}})
 
     # array of a union type defined by a PrimitiveType instance
     number_or_null = JSONSchemaPrimitiveType(['number', 'null'])
     schema = JSONSchemaPrimitiveType('array', items=number_or_null).compile()
-    assert not diff_schemas(schema, {'type': 'array', 'items': {'type': ['null', 'number']}})
+    assert_schema_equal(schema, {'type': 'array', 'items': {'type': ['null', 'number']}})
 
     # invalid primitive type
     with pytest.raises(ValueError):
@@ -48,6 +66,10 @@ def test_json_primitive_type_compile():
     with pytest.raises(ValueError):
         JSONSchemaPrimitiveType(['number', 'uhoh'])
 
+    # compound type that includes a non-string (and unhashable) type
+    with pytest.raises(ValueError):
+        JSONSchemaPrimitiveType(['number', ['x']])
+
     # `items` argument is array-specific
     with pytest.raises(ValueError):
         JSONSchemaPrimitiveType('number', items='number')
@@ -64,31 +86,62 @@ def test_jst():
 
     # a literal type
     schema = jst.number.compile()
-    assert not diff_schemas(schema, {'type': 'number'})
+    assert_schema_equal(schema, {'type': 'number'})
 
     # a union type
     schema = jst.number_or_null.compile()
-    assert not diff_schemas(schema, {'type': ['null', 'number']})
+    assert_schema_equal(schema, {'type': ['null', 'number']})
 
     # a larger union type
     schema = jst.number_or_string_or_boolean.compile()
-    assert not diff_schemas(schema, {'type': ['string', 'number', 'boolean']})
+    assert_schema_equal(schema, {'type': ['string', 'number', 'boolean']})
 
     # array of a literal type
     schema = jst.string_array.compile()
-    assert not diff_schemas(schema, {'type': 'array', 'items': {'type': 'string'}})
+    assert_schema_equal(schema, {'type': 'array', 'items': {'type': 'string'}})
 
     # array of a union type
     schema = jst.number_or_null_array.compile()
-    assert not diff_schemas(schema, {'type': 'array', 'items': {'type': ['number', 'null']}})
+    assert_schema_equal(schema, {'type': 'array', 'items': {'type': ['number', 'null']}})
+
+    # the order of the types in a union type does not matter
+    assert jst.null_or_boolean_or_string_array == jst.string_or_null_or_boolean_array
 
     # literal type with additional properties, set both at and after instantiation
     schema = jst.number(minimum=10, maximum=100)(multipleOf=3).compile()
-    assert not diff_schemas(
+    assert_schema_equal(
         schema, {'type': 'number', 'minimum': 10, 'maximum': 100, 'multipleOf': 3}
     )
 
-    invalid_types = ['bool', 'num_or_string', 'number_or_number', 'number_and_string']
+    # properties set on one instance do not leak into later lookups of the same type
+    assert_schema_equal(jst.number.compile(), {'type': 'number'})
+
+    # mutating a compiled schema does not affect later compilations of the same type
+    compiled_schema = compile_schema({'a': jst.number_or_null, 'b': jst.string_array})
+    compiled_schema['properties']['a']['type'].append('string')
+    compiled_schema['properties']['b']['items']['type'] = 'boolean'
+    assert_schema_equal(jst.number_or_null.compile(), {'type': ['null', 'number']})
+    assert_schema_equal(
+        jst.string_array.compile(), {'type': 'array', 'items': {'type': 'string'}}
+    )
+
+    # setting properties returns a new instance
+    number = jst.number
+    assert number(minimum=10) is not number
+    assert not number.props
+
+    # instances can be copied and pickled
+    number = jst.number(minimum=1)
+    assert copy.deepcopy({'a': number}) == {'a': number}
+    assert pickle.loads(pickle.dumps(number)) == number
+
+    invalid_types = [
+        'bool',
+        'num_or_string',
+        'number_or_number',
+        'number_and_string',
+        'number_or_number_array',
+    ]
     for invalid_type in invalid_types:
         with pytest.raises(AttributeError):
             getattr(jst, invalid_type)
@@ -126,17 +179,15 @@ def test_compile_schema():
                     'names': {
                         'type': 'object',
                         'properties': {'gene': {'type': 'string'}, 'protein': {'type': 'string'}},
-                        '$defs': {},
                     },
                 },
-                '$defs': {},
             },
         },
         '$defs': {},
     }
     compiled_schema = compile_schema(schema)
     check_schema(compiled_schema)
-    assert not diff_schemas(compiled_schema, expected_compiled_schema)
+    assert_schema_equal(compiled_schema, expected_compiled_schema)
 
     # schema with a property whose type is an array of dicts
     schema = {
@@ -158,7 +209,7 @@ def test_compile_schema():
     }
     compiled_schema = compile_schema(schema)
     check_schema(compiled_schema)
-    assert not diff_schemas(compiled_schema, expected_compiled_schema)
+    assert_schema_equal(compiled_schema, expected_compiled_schema)
 
     # schema with nested arrays of dicts
     schema = {
@@ -195,11 +246,81 @@ def test_compile_schema():
     }
     compiled_schema = compile_schema(schema)
     check_schema(compiled_schema)
-    assert not diff_schemas(compiled_schema, expected_compiled_schema)
+    assert_schema_equal(compiled_schema, expected_compiled_schema)
+
+    # schema with an array of dicts in a nested object schema
+    schema = {'metadata': {'data': [{'x': jst.number}]}}
+    expected_compiled_schema = {
+        'type': 'object',
+        'properties': {
+            'metadata': {
+                'type': 'object',
+                'properties': {
+                    'data': {'type': 'array', 'items': {'$ref': '#/$defs/data'}},
+                },
+            },
+        },
+        '$defs': {
+            'data': {'type': 'object', 'properties': {'x': {'type': 'number'}}},
+        },
+    }
+    compiled_schema = compile_schema(schema)
+    check_schema(compiled_schema)
+    assert_schema_equal(compiled_schema, expected_compiled_schema)
+
+    # schema in which the same element schema is used by more than one array-typed property
+    point = {'x': jst.number, 'y': jst.number}
+    schema = {'start': [point], 'end': [point]}
+    expected_compiled_schema = {
+        'type': 'object',
+        'properties': {
+            'start': {'type': 'array', 'items': {'$ref': '#/$defs/start'}},
+            'end': {'type': 'array', 'items': {'$ref': '#/$defs/start'}},
+        },
+        '$defs': {
+            'start': {
+                'type': 'object',
+                'properties': {'x': {'type': 'number'}, 'y': {'type': 'number'}},
+            },
+        },
+    }
+    compiled_schema = compile_schema(schema)
+    check_schema(compiled_schema)
+    assert_schema_equal(compiled_schema, expected_compiled_schema)
+
+
+def test_compile_schema_subclasses():
+    '''
+    Test that raw schemas defined with subclasses of dict and list compile like dicts and lists
+    '''
+
+    class RawList(list):
+        pass
+
+    schema = collections.OrderedDict(
+        [('name', jst.string), ('data', RawList([collections.OrderedDict(x=jst.number)]))]
+    )
+    expected_compiled_schema = {
+        'type': 'object',
+        'properties': {
+            'name': {'type': 'string'},
+            'data': {'type': 'array', 'items': {'$ref': '#/$defs/data'}},
+        },
+        '$defs': {'data': {'type': 'object', 'properties': {'x': {'type': 'number'}}}},
+    }
+    compiled_schema = compile_schema(schema)
+    check_schema(compiled_schema)
+    assert_schema_equal(compiled_schema, expected_compiled_schema)
 
 
 def test_compile_top_level_arrays():
 
+    # schema with a top-level array of a primitive type, which has no schema defs
+    schema = [jst.number]
+    compiled_schema = compile_schema(schema)
+    check_schema(compiled_schema)
+    assert compiled_schema == {'type': 'array', 'items': {'type': 'number'}}
+
     # schema with a top-level array of dicts
     schema = [
         {
@@ -227,7 +348,28 @@ def test_compile_top_level_arrays():
     }
     compiled_schema = compile_schema(schema)
     check_schema(compiled_schema)
-    assert not diff_schemas(compiled_schema, expected_compiled_schema)
+    assert_schema_equal(compiled_schema, expected_compiled_schema)
+
+
+def test_compile_deeply_nested_schema():
+    '''
+    Test that compiling deeply nested schemas does not hit the recursion limit
+    '''
+    depth = 5000
+    schema = {'x': jst.number}
+    for _ in range(depth):
+        schema = {'child': schema}
+
+    compiled_schema = compile_schema(schema)
+    for _ in range(depth):
+        compiled_schema = compiled_schema['properties']['child']
+    assert_schema_equal(compiled_schema['properties'], {'x': {'type': 'number'}})
+
+    compiled_schema = compile_schema(schema, require_all=True)
+    for _ in range(depth):
+        assert compiled_schema['required'] == ['child']
+        compiled_schema = compiled_schema['properties']['child']
+    assert compiled_schema['required'] == ['x']
 
 
 def test_compile_schema_errors():
@@ -239,6 +381,11 @@ def test_compile_schema_errors():
     with pytest.raises(ValueError):
         compile_schema(schema)
 
+    # schema with an array of arrays of object schemas
+    schema = {'a': [[{'x': jst.number}]]}
+    with pytest.raises(ValueError):
+        compile_schema(schema)
+
     # schema with duplicated sub-schema-typed properties (the 'data' properties)
     schema = {
         'name': jst.string_or_null,
@@ -264,18 +411,26 @@ def test_schema_validation():
     valid_instance = [0, 1, 2, None]
     invalid_instance = [0, '0']
 
-    jsonschema.validate(valid_instance, compile_schema(schema, require_all=True))
+    compiled_schema, validator = make_validator(schema)
+    strict_compiled_schema, strict_validator = make_validator(schema, require_all=True)
+    check_schema(compiled_schema)
+    check_schema(strict_compiled_schema)
+    strict_validator.validate(valid_instance)
     with pytest.raises(jsonschema.ValidationError):
-        jsonschema.validate(invalid_instance, compile_schema(schema))
+        validator.validate(invalid_instance)
 
     # top-level array of dicts
     schema = [{'x': jst.number}]
     valid_instance = [{'x': 0}, {'x': 1}]
     invalid_instance = [{'x': '0'}]
 
-    jsonschema.validate(valid_instance, compile_schema(schema, require_all=True))
+    compiled_schema, validator = make_validator(schema)
+    strict_compiled_schema, strict_validator = make_validator(schema, require_all=True)
+    check_schema(compiled_schema)
+    check_schema(strict_compiled_schema)
+    strict_validator.validate(valid_instance)
     with pytest.raises(jsonschema.ValidationError):
-        jsonschema.validate(invalid_instance, compile_schema(schema))
+        validator.validate(invalid_instance)
 
     # complex schema with nested arrays of dicts
     schema = {
@@ -296,19 +451,27 @@ def test_schema_validation():
             {'id': 1, 'values': [{'x': 0, 'y': 0}]},
         ],
     }
-    jsonschema.validate(valid_instance, compile_schema(schema, require_all=True))
+
+    # compile each schema and construct its validator only once
+    compiled_schema, validator = make_validator(schema)
+    strict_compiled_schema, strict_validator = make_validator(schema, require_all=True)
+    check_schema(compiled_schema)
+    check_schema(strict_compiled_schema)
+
+    strict_validator.validate(valid_instance)
 
     # invalid sample_name
     invalid_instance = copy.deepcopy(valid_instance)
     invalid_instance['sample_names'][0] = 123
     with pytest.raises(jsonschema.ValidationError):
-        jsonschema.validate(invalid_instance, compile_schema(schema))
+        validator.validate(invalid_instance)
 
     # invalid 'x' value
     invalid_instance = copy.deepcopy(valid_instance)
     invalid_instance['datasets'][0]['values'][0]['x'] = -111
     with pytest.raises(jsonschema.ValidationError):
-        jsonschema.validate(invalid_instance, compile_schema(schema))
+        validator.validate(invalid_instance)
+    assert len(list(validator.iter_errors(invalid_instance))) == 1
 
     # drop the 'id' property in the first dataset
     instance_missing_property = copy.deepcopy(valid_instance)
@@ -316,8 +479,12 @@ def test_schema_validation():
 
     # the instance with a missing 'id' property is still valid,
     # because jsonschema properties are optional by default
-    jsonschema.validate(instance_missing_property, compile_schema(schema))
+    validator.validate(instance_missing_property)
 
     # the instance is not valid if all properties are required
     with pytest.raises(jsonschema.ValidationError):
-        jsonschema.validate(instance_missing_property, compile_schema(schema, require_all=True))
+        strict_validator.validate(instance_missing_property)
+
+    # invalid schemas are rejected when the validator is constructed
+    with pytest.raises(jsonschema.SchemaError):
+        make_validator({'x': jst.number(minimum='x')})
@@ -1,43 +1,70 @@
+import collections
 import dataclasses
+import itertools
 
+from typing import Any, Mapping, Optional, Tuple
 
+import jsonschema
+
+
+def _normalize_types(types):
+    '''
+    Normalize the `types` argument of `JSONSchemaPrimitiveType` to a sorted tuple of type names
+    '''
+    if isinstance(types, str):
+        types = (types,)
+
+    if isinstance(types, (list, tuple)):
+        for type_ in types:
+            # check for strings first, since unhashable values cannot be looked up in a set
+            if not isinstance(type_, str) or type_ not in JSONSchemaPrimitiveType.valid_types:
+                raise ValueError("Invalid primitive type '%s'" % type_)
+    else:
+        raise TypeError(
+            '`types` must be a list of strings or an instance of `JSONSchemaPrimitiveType`'
+        )
+
+    return tuple(sorted(types))
+
+
+@dataclasses.dataclass(frozen=True, repr=False)
 class JSONSchemaPrimitiveType:
+    '''
+    An immutable primitive or union type
 
-    valid_types = ['string', 'number', 'boolean', 'array', 'null']
+    Calling an instance with keyword arguments returns a new instance
+    with the keyword arguments added to its type-specific properties
+    '''
 
-    def __init__(self, types, items=None):
+    # the valid types in a stable order, for where order matters,
+    # and as a frozenset, for membership checks
+    _valid_types_order = ('string', 'number', 'boolean', 'array', 'null')
+    valid_types = frozenset(_valid_types_order)
 
-        if isinstance(types, str):
-            types = [types]
+    types: Tuple[str, ...]
+    items: Optional['JSONSchemaPrimitiveType'] = None
 
-        if isinstance(types, list):
-            for type_ in types:
-                if type_ not in self.valid_types:
-                    raise ValueError("Invalid primitive type '%s'" % type_)
-        else:
-            raise TypeError(
-                '`types` must be a list of strings or an instance of `JSONSchemaPrimitiveType`'
-            )
+    # type-specific properties
+    # TODO: validate these according to the json-schema spec
+    props: Mapping[str, Any] = dataclasses.field(default_factory=dict, hash=False)
 
-        self.types = types
+    def __post_init__(self):
 
-        if isinstance(items, JSONSchemaPrimitiveType):
-            self.items = items
-        elif items is not None:
-            self.items = JSONSchemaPrimitiveType(types=items)
-        else:
-            self.items = None
+        # the instance is frozen, so the normalized fields are set with `object.__setattr__`
+        object.__setattr__(self, 'types', _normalize_types(self.types))
+
+        items = self.items
+        if items is not None and not isinstance(items, JSONSchemaPrimitiveType):
+            object.__setattr__(self, 'items', JSONSchemaPrimitiveType(types=items))
 
         if self.items is not None and 'array' not in self.types:
             raise ValueError('items can only be specified for array types')
 
-        # type-specific properties
-        # TODO: validate these according to the json-schema spec
-        self.props = {}
+        object.__setattr__(self, 'props', dict(self.props))
 
     def compile(self):
         ''' '''
-        value = {'type': self.types[0] if len(self.types) == 1 else self.types}
+        value = {'type': self.types[0] if len(self.types) == 1 else list(self.types)}
         if self.items is not None:
             value['items'] = self.items.compile()
 
@@ -51,8 +78,7 @@ class JSONSchemaPrimitiveType:
         return s
 
     def __call__(self, **kwargs):
-        self.props.update(kwargs)
-        return self
+        return dataclasses.replace(self, props={**self.props, **kwargs})
 
 
 class JSONSchemaTypes:
@@ -68,63 +94,73 @@ class JSONSchemaTypes:
         JSONSchemaTypes().number_or_null
         JSONSchemaTypes().number_or_string_null
         JSONSchemaTypes().number_or_null_array
-    '''
 
-    def __getattr__(self, attr):
-
-        if attr in JSONSchemaPrimitiveType.valid_types:
-            type_args = (attr,)
+    The types for all valid attribute names are precomputed once, when the module is imported;
+    the precomputed instances have empty props and, because they are immutable,
+    can be safely shared between lookups
+    '''
 
-        elif attr.endswith('_array'):
-            items = attr.replace('_array', '').split('_or_')
-            type_args = ('array', items)
+    _table = {}
+
+    @classmethod
+    def _build_table(cls):
+        '''
+        Enumerate all unions of the valid primitive types, in every order,
+        and the arrays of these unions
+        '''
+        table = {}
+        valid_types = JSONSchemaPrimitiveType._valid_types_order
+        for num_types in range(1, len(valid_types) + 1):
+            for types in itertools.combinations(valid_types, num_types):
+                union_type = JSONSchemaPrimitiveType(types)
+                array_type = JSONSchemaPrimitiveType('array', items=union_type)
+                for ordered_types in itertools.permutations(types):
+                    name = '_or_'.join(ordered_types)
+                    table[name] = union_type
+                    table[name + '_array'] = array_type
+        return table
 
-        elif '_or_' in attr:
-            types = attr.split('_or_')
-            if len(set(types)) != len(types):
-                raise AttributeError("Invalid composite type '%s'" % attr)
-            type_args = (types,)
-        else:
-            raise AttributeError("Invalid composite type '%s'" % attr)
-
-        try:
-            primitive_type = JSONSchemaPrimitiveType(*type_args)
-        except ValueError:
+    def __getattr__(self, attr):
+        value = type(self)._table.get(attr)
+        if value is None:
             raise AttributeError("Invalid composite type '%s'" % attr)
+        return value
 
-        return primitive_type
 
+JSONSchemaTypes._table = JSONSchemaTypes._build_table()
 
 jst = JSONSchemaTypes()
 
 
-@dataclasses.dataclass(init=False)
-class KW:
-    '''
-    keywords in the JSON schema definition
-    '''
+# keywords in the JSON schema definition
+_TYPE = 'type'
+_ITEMS = 'items'
+_DEFS = '$defs'
+_REF = '$ref'
+_PROPERTIES = 'properties'
+_OBJECT = 'object'
+_ARRAY = 'array'
 
-    type = 'type'
-    items = 'items'
-    defs = '$defs'
-    ref = '$ref'
-    properties = 'properties'
-    object = 'object'
-    array = 'array'
+# the prefix of the `$ref` to a schema definition
+_REF_PREFIX = f'#/{_DEFS}/'
 
 
 def _require_all_properties(compiled_schema):
     '''
     Helper function to define all properties as required in the compiled schema
+    and in any nested object schemas
     '''
-    property_names = compiled_schema.get('properties').keys()
-    compiled_schema['required'] = list(property_names)
-    for property_name in property_names:
-        if compiled_schema['properties'][property_name].get('type') == 'object':
-            _require_all_properties(compiled_schema['properties'][property_name])
+    worklist = collections.deque([compiled_schema])
+    while worklist:
+        schema = worklist.popleft()
+        properties = schema.get(_PROPERTIES)
+        if not properties:
+            continue
+        schema['required'] = list(properties)
+        worklist.extend(value for value in properties.values() if value.get(_TYPE) == _OBJECT)
 
 
-def compile_schema(raw_schema, require_all=False, _schema_defs=None):
+def compile_schema(raw_schema, require_all=False):
     '''
     Compile a raw schema into the json-schema format
     by moving the properties to a 'properties' dict,
@@ -134,89 +170,117 @@ def compile_schema(raw_schema, require_all=False, _schema_defs=None):
     Note that the 'raw schema' means a literal dict whose values
     are instances of JSONSchemaPrimitiveType (or nested dicts of same)
 
+    The raw schema is traversed iteratively, using a worklist of (parent, key, raw_schema)
+    items, where `parent[key]` is the location of the compiled `raw_schema`
+    in the compiled schema
+
     Example:
     '''
 
     if isinstance(raw_schema, JSONSchemaPrimitiveType):
         return raw_schema.compile()
 
-    if isinstance(raw_schema, list):
-        return _compile_array_schema(raw_schema, require_all=require_all)
+    # the definitions of the object schemas that are the elements of array-typed properties
+    schema_defs = {}
+
+    # the def_ids of the element schemas that have already been compiled, keyed by `id`
+    # (the ids are stable because the raw schema is alive for the duration of the compilation)
+    def_ids_by_element_schema_id = {}
+
+    # placeholder parent for the top-level compiled schema
+    top_level = {}
+    worklist = collections.deque([(top_level, None, raw_schema)])
+
+    # bind the worklist methods once, since they are called once per node in the raw schema
+    extend_worklist = worklist.extend
+    pop_worklist = worklist.popleft
 
-    elif isinstance(raw_schema, dict):
+    def push_object_schema(raw_object_schema):
 
-        compiled_schema = {KW.type: KW.object, KW.properties: {}}
+        # fast path for flat object schemas, whose properties can all be compiled immediately
+        values = raw_object_schema.values()
+        if all(isinstance(value, JSONSchemaPrimitiveType) for value in values):
+            properties = {name: value.compile() for name, value in raw_object_schema.items()}
+            return {_TYPE: _OBJECT, _PROPERTIES: properties}
 
-        # _schema_defs is None only for initial/top-level calls to `compile_schema`
-        if _schema_defs is None:
-            compiled_schema[KW.defs] = {}
-            _schema_defs = compiled_schema[KW.defs]
+        # the properties are compiled later, when their worklist items are processed,
+        # but they are inserted now so that the properties dict is allocated only once
+        properties = dict.fromkeys(raw_object_schema)
+        compiled_schema = {_TYPE: _OBJECT, _PROPERTIES: properties}
+        extend_worklist((properties, name, value) for name, value in raw_object_schema.items())
+        return compiled_schema
 
-        for property_name, property_schema in raw_schema.items():
+    while worklist:
+        parent, key, raw_schema = pop_worklist()
 
-            if isinstance(property_schema, JSONSchemaPrimitiveType):
-                compiled_property_schema = property_schema.compile()
+        if isinstance(raw_schema, JSONSchemaPrimitiveType):
+            parent[key] = raw_schema.compile()
 
-            elif isinstance(property_schema, list):
-                compiled_property_schema = _compile_array_schema(
-                    property_schema,
-                    def_id=property_name,
-                    schema_defs=_schema_defs,
-                    require_all=require_all,
+        elif isinstance(raw_schema, list):
+
+            # by definition, if the property is a list, then the property schema is an array
+            # whose element schema is defined by the sole element in the list
+            if len(raw_schema) != 1:
+                raise ValueError(
+                    'Array-typed property schemas must be a list with a single element'
                 )
 
-            # if the property is itself an object schema
-            else:
-                compiled_property_schema = compile_schema(property_schema)
+            element_schema = raw_schema[0]
 
-            compiled_schema[KW.properties][property_name] = compiled_property_schema
+            # if the element schema is a primitive type
+            if not isinstance(element_schema, dict):
+                parent[key] = JSONSchemaPrimitiveType(_ARRAY, items=element_schema).compile()
+                continue
 
-    if require_all:
-        _require_all_properties(compiled_schema)
+            # if the same element schema has already been compiled, reuse its definition
+            def_id = def_ids_by_element_schema_id.get(id(element_schema))
+            if def_id is None:
 
-    return compiled_schema
+                # if the element schema is an object schema, we need to define a sub-schema
+                # and add its definition to the schema_defs
+                def_id = 'top_level_array_element' if parent is top_level else key
 
+                # check that the new sub-schema definition id is unique
+                if def_id in schema_defs:
+                    raise ValueError('Object-typed property names must be globally unique')
 
-def _compile_array_schema(raw_schema, def_id=None, schema_defs=None, require_all=False):
-    ''' '''
+                def_ids_by_element_schema_id[id(element_schema)] = def_id
+                schema_defs[def_id] = push_object_schema(element_schema)
 
-    assert isinstance(raw_schema, list)
+            parent[key] = {_TYPE: _ARRAY, _ITEMS: {_REF: _REF_PREFIX + def_id}}
 
-    # by definition, if the property is a list, then the property schema is an array
-    # whose element schema is defined by the sole element in the list
-    if len(raw_schema) != 1:
-        raise ValueError('Array-typed property schemas must be a list with a single element')
+        # if the property is itself an object schema
+        else:
+            parent[key] = push_object_schema(raw_schema)
 
-    element_schema = raw_schema[0]
-    element_schema_is_subschema = isinstance(element_schema, dict)
+    # the schema defs are included in the top-level schema,
+    # unless it is an array of primitive types (which has no schema defs)
+    compiled_schema = top_level[None]
+    if compiled_schema[_TYPE] == _OBJECT or schema_defs:
+        compiled_schema[_DEFS] = schema_defs
 
-    # if the element schema is a primitive type
-    if not element_schema_is_subschema:
-        return JSONSchemaPrimitiveType(KW.array, items=element_schema).compile()
+    if require_all:
+        if compiled_schema[_TYPE] == _OBJECT:
+            _require_all_properties(compiled_schema)
+        for schema_def in schema_defs.values():
+            _require_all_properties(schema_def)
 
-    # whether the array is the top level in the original raw schema
-    # (instead of the schema of some property in the original raw schema)
-    array_is_top_level = schema_defs is None
-    if array_is_top_level:
-        schema_defs = {}
-        def_id = 'top_level_array_element'
+    return compiled_schema
 
-    # if the element schema is an object schema, we need to define a sub-schema
-    # and add its definition to the schema_defs
-    compiled_schema = {KW.type: KW.array, KW.items: {KW.ref: f'#/{KW.defs}/{def_id}'}}
 
-    # if the schema we are compiling is the top-level schema,
-    # we need to include the schema defs
-    if array_is_top_level:
-        compiled_schema[KW.defs] = schema_defs
+def make_validator(raw_schema, require_all=False, cls=jsonschema.Draft7Validator):
+    '''
+    Compile a raw schema and construct a validator for it
 
-    # recursively compile the sub-schema
-    schema_def = compile_schema(element_schema, _schema_defs=schema_defs, require_all=require_all)
+    The validator should be reused to validate many instances,
+    to avoid recompiling the schema and rebuilding the validator for each instance
 
-    # check that the new sub-schema definition id is unique
-    if def_id in schema_defs:
-        raise ValueError('Object-typed property names must be globally unique')
+    Raises `jsonschema.SchemaError` if the compiled schema is invalid
 
-    schema_defs[def_id] = schema_def
+    Returns a tuple of the compiled schema and the validator
+    '''
+    compiled_schema = compile_schema(raw_schema, require_all=require_all)
 
-    return compiled_schema
+    # check the schema once, as `jsonschema.validate` would on every call
+    cls.check_schema(compiled_schema)
+    return compiled_schema, cls(compiled_schema)